@@ -1,12 +1,16 @@
 import streamlit as st
-import google.generativeai as genai
 import pandas as pd
 import json
+import orjson
+import json_repair
+import re
 from PIL import Image
 import io
 import datetime
-import xlsxwriter
-import plotly.express as px
+import asyncio
+import hashlib
+import math
+import numbers
 
 # --- PAGE CONFIGURATION ---
 st.set_page_config(
@@ -22,27 +26,100 @@ with st.sidebar:
     
     api_key = st.text_input("Enter Google Gemini API Key", type="password", help="Get your free key from aistudio.google.com")
     
-    # --- DEBUGGER: Check Available Models ---
+    # The key is only bound to this session's client when a batch runs
+    # (scan_files), so reruns here stay free of SDK and network work.
     if api_key:
-        try:
-            genai.configure(api_key=api_key)
-            st.success("API Key Accepted ✅")
-        except:
-            st.error("Invalid API Key")
+        st.success("API Key Accepted ✅")
 
     st.info("ℹ️ **Privacy:** Data is processed in-memory and deleted after use.")
 
 # --- GEMINI AI SETUP ---
+# Files are scanned concurrently; keep the number of in-flight requests small
+# enough to stay under the free-tier rate limit.
+MAX_CONCURRENT_REQUESTS = 5
+# Long-edge bound for scans sent to the model; forms stay legible well below
+# phone-camera resolution.
+MAX_IMAGE_EDGE = 1600
+
 def get_model(api_key):
-    genai.configure(api_key=api_key)
+    # Kept in this session's state so reruns and repeat clicks reuse one model.
+    # Nothing is shared across sessions, and the key is dropped together with
+    # the session. The model's client is bound per batch in scan_files.
+    cached = st.session_state.get("gemini_model")
+    if cached is not None and cached[0] == api_key:
+        return cached[1]
+
+    # The SDK (grpc, protobuf) takes about half a second to import, and only
+    # batch processing needs it.
+    import google.generativeai as genai
+
     # Using 'gemini-1.5-flash' which is the standard free tier model alias
-    return genai.GenerativeModel('gemini-1.5-flash')
+    model = genai.GenerativeModel('gemini-1.5-flash')
+    st.session_state.gemini_model = (api_key, model)
+    return model
 
 # --- INTELLIGENT OCR & PARSING ---
-def process_image(model, image_file):
-    img = Image.open(image_file)
-    
-    prompt = """
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+_JSON_DECODER = json.JSONDecoder()
+
+def parse_reply(text):
+    """Return the JSON object in a model reply, ignoring code fences and surrounding prose.
+
+    Returns a ``(data, repaired)`` pair; ``repaired`` is true when the reply was
+    not valid JSON and had to be patched up, so its fields may be incomplete.
+    """
+    match = _FENCE_RE.search(text)
+    body = match.group(1) if match else text
+    start = body.find("{")
+    if start == -1:
+        raise ValueError("No JSON object in model reply")
+    try:
+        return orjson.loads(body[start:body.rfind("}") + 1]), False
+    except orjson.JSONDecodeError:
+        pass
+    try:
+        # Prose after the object can hold braces of its own ("{illegible}"),
+        # so decode just the first complete value instead.
+        return _JSON_DECODER.raw_decode(body, start)[0], False
+    except json.JSONDecodeError:
+        pass
+    # Last resort for the usual model slips: trailing commas, single quotes,
+    # missing commas or an unterminated string. Trailing prose makes the
+    # repairer return a list of values; the object is the first of them.
+    data = json_repair.loads(body[start:])
+    if isinstance(data, list) and data:
+        data = data[0]
+    if not isinstance(data, dict):
+        raise ValueError("Could not repair JSON in model reply")
+    # A reply cut off right after "{" repairs to {}; that is a failed scan,
+    # not a form with every field missing.
+    if not data.keys() & SCHEMA.keys():
+        raise ValueError("Repaired JSON has no form fields")
+    return data, True
+
+# Every extracted field and the format the model is asked for. The order is
+# the column order of the table and the Excel export.
+SCHEMA = {
+    "report_no": "String",
+    "date_of_report": "DD-MM-YYYY",
+    "location": "String",
+    "department": "String",
+    "hazard_description": "String",
+    "severity_initial": "String",
+    "probability_initial": "String",
+    "risk_level_initial": "String",
+    "cap_required": "Yes/No",
+    "cap_action_plan": "String",
+    "responsible_person": "String",
+    "target_date": "DD-MM-YYYY",
+    "wet_lease_involved": "Yes/No",
+    "operator_name": "String",
+    "report_attached": "Yes/No",
+}
+
+_SCHEMA_FIELDS = ",\n".join(f'        "{field}": "{fmt}"' for field, fmt in SCHEMA.items())
+
+EXTRACTION_PROMPT = f"""
     Analyze this AirSial Hazard Identification & Risk Assessment Form (AS-SMS-003).
     Extract all data into a strictly valid JSON format.
     
@@ -53,109 +130,220 @@ def process_image(model, image_file):
     4. Normalize dates to DD-MM-YYYY.
 
     Return JSON with these exact keys:
-    {
-        "report_no": "String",
-        "date_of_report": "DD-MM-YYYY",
-        "location": "String",
-        "department": "String",
-        "hazard_description": "String",
-        "severity_initial": "String",
-        "probability_initial": "String",
-        "risk_level_initial": "String",
-        "cap_required": "Yes/No",
-        "cap_action_plan": "String",
-        "responsible_person": "String",
-        "target_date": "DD-MM-YYYY",
-        "wet_lease_involved": "Yes/No",
-        "operator_name": "String",
-        "report_attached": "Yes/No"
-    }
+    {{
+{_SCHEMA_FIELDS}
+    }}
     """
-    
-    # Default fallback data
-    default_data = {
-        "report_no": f"Error-{image_file.name}", "date_of_report": "N/A", 
-        "location": "N/A", "department": "N/A", "hazard_description": "Extraction Failed",
-        "severity_initial": "N/A", "probability_initial": "N/A", "risk_level_initial": "N/A",
-        "cap_required": "No", "cap_action_plan": "N/A", "responsible_person": "N/A",
-        "target_date": "N/A", "wet_lease_involved": "No", "operator_name": "N/A", 
-        "report_attached": "No"
-    }
+
+def _prepare_image(image_file):
+    img = Image.open(image_file)
+    # For JPEGs, have libjpeg decode at a reduced DCT scale (1/2, 1/4, 1/8)
+    # instead of inflating the full-resolution photo first. No-op for PNG.
+    scale = MAX_IMAGE_EDGE / max(img.size)
+    if scale < 1:
+        img.draft(None, (round(img.width * scale), round(img.height * scale)))
+    img.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.LANCZOS)
+    # Hand the SDK ready-made JPEG bytes: given a PIL image it re-encodes it as
+    # lossless WebP, which is slow and several times larger to upload.
+    buf = io.BytesIO()
+    img.convert('RGB').save(buf, 'JPEG', quality=85, optimize=True)
+    return {"mime_type": "image/jpeg", "data": buf.getvalue()}
+
+# Longest error message kept in hazard_description for a failed scan.
+ERROR_MESSAGE_CHARS = 120
+
+# Default fallback data. report_no is filled from the file name per scan.
+DEFAULT_DATA = {field: "N/A" for field in SCHEMA}
+DEFAULT_DATA.update({
+    "hazard_description": "Extraction Failed",
+    "cap_required": "No", "wet_lease_involved": "No", "report_attached": "No",
+})
+
+async def process_image(model, image_file, semaphore, cache):
+    fallback_report_no = f"Error-{image_file.name}"
+
+    # Re-uploads of the same scan reuse the earlier extraction. The prompt is
+    # part of the key so editing it invalidates old entries.
+    key = hashlib.sha256(EXTRACTION_PROMPT.encode() + image_file.getvalue()).hexdigest()
+    if key in cache:
+        return {**DEFAULT_DATA, "report_no": fallback_report_no, **cache[key]}
 
     try:
-        response = model.generate_content([prompt, img])
-        text = response.text
-        # Clean markdown formatting
-        if "```json" in text:
-            text = text.split("```json")[1].split("```")[0]
-        elif "```" in text:
-            text = text.split("```")[1]
-        
-        data = json.loads(text)
-        return {**default_data, **data}
+        # Decoding sits inside the try so an unreadable upload becomes an error
+        # row for that file instead of aborting the whole batch, and inside the
+        # semaphore so only in-flight scans hold a decoded image.
+        async with semaphore:
+            img = await asyncio.to_thread(_prepare_image, image_file)
+            response = await model.generate_content_async([EXTRACTION_PROMPT, img])
+        data, repaired = parse_reply(response.text)
+        row = {**DEFAULT_DATA, "report_no": fallback_report_no, **data}
+        if repaired:
+            # Truncated or malformed replies may have lost fields; flag the row
+            # so it is checked against the paper form.
+            row["extraction_error"] = "RepairedReply"
+        elif data.keys() & SCHEMA.keys():
+            # Only clean extractions are reused; a flagged or empty reply is
+            # retried on the next upload instead.
+            cache[key] = data
+        return row
     except Exception as e:
-        default_data["hazard_description"] = f"AI Error: {str(e)}"
-        return default_data
+        # Quota errors can carry multi-line retry payloads. Keep only a short
+        # first line in the free-text column; the error class goes in its own
+        # column so failed rows can be filtered in Excel.
+        message = (str(e).splitlines() or [""])[0][:ERROR_MESSAGE_CHARS]
+        return {**DEFAULT_DATA, "report_no": fallback_report_no,
+                "hazard_description": f"AI Error: {message}", "extraction_error": type(e).__name__}
+
+async def scan_files(model, api_key, files, on_progress, cache):
+    """Scan all files concurrently and return their rows in upload order."""
+    import google.ai.generativelanguage as glm
+
+    # grpc.aio channels belong to the event loop that created them, so each
+    # batch binds a fresh async client for this session's key inside its own
+    # loop. The key never goes through the process-global genai.configure().
+    model._async_client = glm.GenerativeServiceAsyncClient(client_options={"api_key": api_key})
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def scan(i, image_file):
+        return i, await process_image(model, image_file, semaphore, cache)
+
+    results = [None] * len(files)
+    try:
+        pending = [scan(i, f) for i, f in enumerate(files)]
+        for done, next_result in enumerate(asyncio.as_completed(pending), start=1):
+            i, data = await next_result
+            results[i] = data
+            on_progress(done)
+    finally:
+        await model._async_client.transport.close()
+    return results
+
+# --- RESULTS TABLE ---
+# Answers drawn from a handful of values become categoricals; long free text
+# is stored as Arrow strings instead of Python objects.
+ENUM_COLS = ('severity_initial', 'probability_initial', 'risk_level_initial', 'cap_required',
+             'wet_lease_involved', 'report_attached', 'location', 'department', 'extraction_error')
+TEXT_COLS = ('hazard_description', 'cap_action_plan', 'responsible_person', 'operator_name')
+
+def results_frame(results):
+    # The schema is known up front, so pandas can skip inferring the column set
+    # from every row's keys. Keys the model adds beyond it are dropped.
+    columns = [*SCHEMA, 'extraction_error']
+    return compact_columns(pd.DataFrame.from_records(results, columns=columns))
+
+def _holds_numbers(series):
+    # The model sometimes answers with a bare number (severity 3). Excel gets
+    # those as numbers, so such columns are left uncast rather than turned to text.
+    return series.map(lambda v: isinstance(v, numbers.Number) and not pd.isna(v)).any()
+
+def compact_columns(df):
+    for c in TEXT_COLS:
+        if c in df.columns and not _holds_numbers(df[c]):
+            df[c] = df[c].astype('string[pyarrow]')
+    for c in ENUM_COLS:
+        if c in df.columns and not _holds_numbers(df[c]):
+            # Via strings first: the model can return lists/dicts, which a
+            # categorical can't hold.
+            df[c] = df[c].astype('string[pyarrow]').astype('category')
+    return df
 
 # --- EXCEL GENERATOR ---
+def _excel_value(value):
+    # Same coercion as DataFrame.to_excel: blanks for missing values, str() for
+    # anything xlsxwriter can't write natively (e.g. nested JSON from the model).
+    if isinstance(value, str):
+        return value
+    if pd.api.types.is_scalar(value) and pd.isna(value):
+        return None
+    if isinstance(value, float) and math.isinf(value):
+        # xlsxwriter rejects infinities; pandas writes them as text (inf_rep).
+        return 'inf' if value > 0 else '-inf'
+    if isinstance(value, (int, float)):
+        return value
+    return str(value)
+
+def _write_sheet(worksheet, columns, rows, header_fmt):
+    worksheet.write_row(0, 0, columns, header_fmt)
+    for row_num, row in enumerate(rows, start=1):
+        worksheet.write_row(row_num, 0, [_excel_value(v) for v in row])
+
 def to_excel(df):
+    # Imported here so the upload page doesn't pay for it on every cold start.
+    import xlsxwriter
+
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        workbook = writer.book
+    # constant_memory flushes each row to a temporary file per worksheet once the
+    # next one starts, so rows are written strictly in order here
+    # (DataFrame.to_excel writes column by column). close() assembles the
+    # workbook and deletes those files, so it runs even if a write fails.
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    try:
         header_fmt = workbook.add_format({'bold': True, 'bg_color': '#1f4e78', 'font_color': 'white', 'border': 1})
-        
+
         # 1. Raw Data Sheet
-        df.to_excel(writer, sheet_name='Raw SMS Data', index=False)
-        worksheet = writer.sheets['Raw SMS Data']
-        for col_num, value in enumerate(df.columns.values):
-            worksheet.write(0, col_num, value, header_fmt)
-            
+        worksheet = workbook.add_worksheet('Raw SMS Data')
+        _write_sheet(worksheet, df.columns, df.itertuples(index=False), header_fmt)
+
         # 2. CAP Tracker Sheet
         if not df.empty:
             cols = ['report_no', 'cap_action_plan', 'responsible_person', 'target_date', 'cap_required']
             existing = [c for c in cols if c in df.columns]
-            cap_df = df[existing].copy()
-            
-            cap_df.to_excel(writer, sheet_name='CAP Tracker', index=False)
-            ws_cap = writer.sheets['CAP Tracker']
-            for col_num, value in enumerate(cap_df.columns.values):
-                ws_cap.write(0, col_num, value, header_fmt)
 
+            ws_cap = workbook.add_worksheet('CAP Tracker')
+            # Rows come straight from the existing columns; no projected frame is built.
+            _write_sheet(ws_cap, existing, zip(*(df[c] for c in existing)), header_fmt)
+    finally:
+        workbook.close()
     return output.getvalue()
 
 # --- DASHBOARD GENERATOR ---
+def column_counts(df, columns):
+    # One hashed pass per column, shared by the KPI cards and the charts.
+    return {c: df[c].value_counts() for c in columns if c in df.columns}
+
+def safe_count(counts, column, value_substring):
+    # Case-insensitive substring match, run over the distinct values only.
+    if column not in counts: return 0
+    vc = counts[column]
+    return int(vc[vc.index.astype(str).str.contains(value_substring, case=False, regex=False)].sum())
+
 def generate_dashboard(df):
+    # Plotly is only needed once results exist; keep it off the cold-start path.
+    import plotly.colors
+    import plotly.graph_objects as go
+
     st.markdown("---")
     st.header("📊 Monthly SMS Dashboard")
     
-    def safe_count(column, value_substring):
-        if column not in df.columns: return 0
-        return len(df[df[column].astype(str).str.contains(value_substring, case=False, na=False)])
+    counts = column_counts(df, ('risk_level_initial', 'wet_lease_involved', 'cap_required', 'location', 'severity_initial'))
 
     # 1. KPI Cards
     k1, k2, k3, k4 = st.columns(4)
     k1.metric("Total Reports", len(df))
-    k2.metric("High Risk", safe_count('risk_level_initial', 'High'))
-    k3.metric("Wet Lease Incidents", safe_count('wet_lease_involved', 'Yes'))
-    k4.metric("CAPs Pending", safe_count('cap_required', 'Yes'))
+    k2.metric("High Risk", safe_count(counts, 'risk_level_initial', 'High'))
+    k3.metric("Wet Lease Incidents", safe_count(counts, 'wet_lease_involved', 'Yes'))
+    k4.metric("CAPs Pending", safe_count(counts, 'cap_required', 'Yes'))
 
     # 2. Charts
     c1, c2 = st.columns(2)
     
     with c1:
         st.subheader("📍 Hazards by Location")
-        if 'location' in df.columns:
-            loc_counts = df['location'].value_counts().reset_index()
-            loc_counts.columns = ['Location', 'Count']
-            fig = px.bar(loc_counts, x='Location', y='Count', color='Location')
+        if 'location' in counts:
+            loc_counts = counts['location']
+            palette = plotly.colors.qualitative.Plotly
+            fig = go.Figure(go.Bar(
+                x=loc_counts.index, y=loc_counts.values,
+                marker_color=[palette[i % len(palette)] for i in range(len(loc_counts))]
+            ))
+            fig.update_layout(xaxis_title='Location', yaxis_title='Count')
             st.plotly_chart(fig, use_container_width=True)
             
     with c2:
         st.subheader("⚠️ Risk Severity")
-        if 'severity_initial' in df.columns:
-            sev_counts = df['severity_initial'].value_counts().reset_index()
-            sev_counts.columns = ['Severity', 'Count']
-            fig2 = px.pie(sev_counts, values='Count', names='Severity', hole=0.4)
+        if 'severity_initial' in counts:
+            sev_counts = counts['severity_initial']
+            fig2 = go.Figure(go.Pie(labels=sev_counts.index, values=sev_counts.values, hole=0.4))
             st.plotly_chart(fig2, use_container_width=True)
 
 # --- MAIN APP LOGIC ---
@@ -172,18 +360,19 @@ if st.button("🚀 Process Reports"):
     else:
         try:
             model = get_model(api_key)
-            results = []
             bar = st.progress(0, text="Initializing AI...")
-            
-            for i, file in enumerate(uploaded_files):
-                data = process_image(model, file)
-                results.append(data)
-                bar.progress(int(((i + 1) / len(uploaded_files)) * 100), text=f"Scanning {file.name}...")
+
+            def report_progress(done):
+                bar.progress(int((done / len(uploaded_files)) * 100), text=f"{done}/{len(uploaded_files)} scanned")
+
+            # Held in session state only, so cached extractions go away with the session.
+            cache = st.session_state.setdefault("scan_cache", {})
+            results = asyncio.run(scan_files(model, api_key, uploaded_files, report_progress, cache))
             
             bar.empty()
             st.success("✅ Extraction Complete!")
             
-            df = pd.DataFrame(results)
+            df = results_frame(results)
             generate_dashboard(df)
             
             with st.expander("📄 View Raw Data"):
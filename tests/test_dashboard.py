@@ -0,0 +1,50 @@
+import pandas as pd
+import pytest
+
+import app
+
+
+def _baseline_count(df, column, value_substring):
+    # The per-row scan generate_dashboard used before value_counts.
+    if column not in df.columns: return 0
+    return len(df[df[column].astype(str).str.contains(value_substring, case=False, na=False)])
+
+
+DF = pd.DataFrame({
+    "risk_level_initial": ["High", "high", "HIGH RISK", "Low", "N/A", None, float("nan"), "Medium"],
+    "cap_required": ["Yes", "yes", "No", "Yes - urgent", None, "N/A", "no", "YES"],
+    "wet_lease_involved": ["No"] * 8,
+})
+
+
+@pytest.mark.parametrize("column, value_substring", [
+    ("risk_level_initial", "High"),
+    ("cap_required", "Yes"),
+    ("wet_lease_involved", "Yes"),
+    ("missing_column", "Yes"),
+])
+def test_safe_count_matches_row_scan(column, value_substring):
+    counts = app.column_counts(DF, ("risk_level_initial", "cap_required", "wet_lease_involved", "missing_column"))
+    assert app.safe_count(counts, column, value_substring) == _baseline_count(DF, column, value_substring)
+
+
+def test_safe_count_on_empty_frame():
+    df = pd.DataFrame(columns=["cap_required"])
+    assert app.safe_count(app.column_counts(df, ("cap_required",)), "cap_required", "Yes") == 0
+
+
+@pytest.mark.parametrize("df", [
+    DF.assign(location=["Apron", "Apron", "Hangar", None, "Ramp", "Ramp", "Ramp", "Gate"],
+              severity_initial=["Major", "Minor", "Major", None, "Minor", "N/A", "Major", "Minor"]),
+    pd.DataFrame(),
+], ids=["populated", "empty"])
+def test_generate_dashboard_renders(df):
+    app.generate_dashboard(df)
+
+
+def test_safe_count_is_unchanged_on_compacted_columns():
+    counts = app.column_counts(DF, ("risk_level_initial", "cap_required"))
+    compact = app.column_counts(app.compact_columns(DF.copy()), ("risk_level_initial", "cap_required"))
+
+    for column, value_substring in (("risk_level_initial", "High"), ("cap_required", "Yes")):
+        assert app.safe_count(compact, column, value_substring) == app.safe_count(counts, column, value_substring)
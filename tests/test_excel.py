@@ -0,0 +1,90 @@
+import io
+
+import openpyxl
+import pandas as pd
+import pytest
+
+import app
+
+
+def _baseline_to_excel(df):
+    # The DataFrame.to_excel exporter the streaming writer replaced.
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        df.to_excel(writer, sheet_name='Raw SMS Data', index=False)
+        if not df.empty:
+            cols = ['report_no', 'cap_action_plan', 'responsible_person', 'target_date', 'cap_required']
+            existing = [c for c in cols if c in df.columns]
+            df[existing].copy().to_excel(writer, sheet_name='CAP Tracker', index=False)
+    return output.getvalue()
+
+
+def _read(data):
+    wb = openpyxl.load_workbook(io.BytesIO(data))
+    return {ws.title: list(ws.iter_rows(values_only=True)) for ws in wb}
+
+
+FULL = pd.DataFrame([
+    {"report_no": "R1", "cap_action_plan": "Fix light", "responsible_person": "Ops",
+     "target_date": "01-02-2025", "cap_required": "Yes", "extra": {"nested": [1, 2]}},
+    {"report_no": "R2", "cap_action_plan": None, "responsible_person": float("nan"),
+     "target_date": "N/A", "cap_required": "No", "extra": ["a", "b"], "count": 3},
+])
+
+
+@pytest.mark.parametrize("df", [
+    FULL,
+    FULL[["report_no", "cap_required", "extra"]],  # missing CAP columns
+    pd.DataFrame(columns=list(FULL.columns)),
+    pd.DataFrame(),
+    FULL.assign(report_no=[float("inf"), "R2"], count=[3, float("-inf")]),
+], ids=["full", "missing-cap-columns", "empty-with-columns", "empty", "infinite"])
+def test_to_excel_matches_dataframe_to_excel(df):
+    assert _read(app.to_excel(df)) == _read(_baseline_to_excel(df))
+
+
+def test_to_excel_blanks_missing_and_stringifies_nested():
+    rows = _read(app.to_excel(FULL))["Raw SMS Data"]
+
+    assert rows[1][5] == "{'nested': [1, 2]}"
+    assert rows[2][1] is None and rows[2][2] is None
+    assert rows[2][5] == "['a', 'b']"
+    assert rows[2][6] == 3
+
+
+def test_compacted_frame_exports_like_the_object_frame():
+    df = FULL.assign(location=["Apron", {"odd": 1}], hazard_description=["Fuel leak", None],
+                     severity_initial=[3, "Major"], probability_initial=[2, 4], report_attached=[True, "No"])
+    compact = app.compact_columns(df.copy())
+
+    assert compact["location"].dtype == "category"
+    assert compact["hazard_description"].dtype == "string[pyarrow]"
+    assert _read(app.to_excel(compact)) == _read(app.to_excel(df))
+    row = _read(app.to_excel(compact))["Raw SMS Data"][1]
+    assert row[list(df.columns).index("severity_initial")] == 3
+    assert row[list(df.columns).index("probability_initial")] == 2
+    assert row[list(df.columns).index("report_attached")] is True
+
+
+def test_results_frame_uses_the_schema_columns():
+    rows = [
+        {**app.DEFAULT_DATA, "report_no": "R1", "made_up_field": "x"},
+        {**app.DEFAULT_DATA, "report_no": "R2"},
+    ]
+    df = app.results_frame(rows)
+
+    assert list(df.columns) == [*app.SCHEMA, "extraction_error"]
+    assert df["report_no"].tolist() == ["R1", "R2"]
+    assert df["extraction_error"].isna().all()
+    assert list(app.results_frame([]).columns) == [*app.SCHEMA, "extraction_error"]
+
+
+def test_to_excel_cleans_up_when_a_write_fails(monkeypatch, tmp_path):
+    import tempfile
+
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    monkeypatch.setattr(app, "_excel_value", lambda v: 1 / 0)
+
+    with pytest.raises(ZeroDivisionError):
+        app.to_excel(FULL)
+    assert list(tmp_path.iterdir()) == []
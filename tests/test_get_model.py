@@ -0,0 +1,17 @@
+import streamlit as st
+
+import app
+
+
+def test_model_is_reused_for_the_same_key():
+    st.session_state.clear()
+    model = app.get_model("key-a")
+
+    assert app.get_model("key-a") is model
+
+
+def test_changing_key_builds_a_new_model():
+    st.session_state.clear()
+    first = app.get_model("key-a")
+
+    assert app.get_model("key-b") is not first
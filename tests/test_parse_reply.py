@@ -0,0 +1,55 @@
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("text", [
+    '{"report_no": "X"}',
+    '```json\n{"report_no": "X"}\n```',
+    '```\n{"report_no": "X"}\n```',
+    'Here is the data:\n{"report_no": "X"}',
+    '```json\n{"report_no": "X"}\n```\nNote: fields marked {illegible} were set to N/A.',
+    'Here: {"report_no": "X"} hope {this} helps',
+])
+def test_parse_reply_extracts_object(text):
+    assert app.parse_reply(text) == ({"report_no": "X"}, False)
+
+
+def test_parse_reply_keeps_braces_inside_strings():
+    assert app.parse_reply('```json\n{"hazard_description": "see {fig 2}"}\n```') == (
+        {"hazard_description": "see {fig 2}"}, False
+    )
+
+
+def test_parse_reply_without_object_raises():
+    with pytest.raises(ValueError):
+        app.parse_reply("Sorry, I could not read this form.")
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"report_no": "X", "location": "Apron",}', {"report_no": "X", "location": "Apron"}),
+    ("```json\n{'report_no': 'X'}\n```", {"report_no": "X"}),
+    ('{"report_no": "X" "location": "Apron"}', {"report_no": "X", "location": "Apron"}),
+    ('{"report_no": "X",} Note: {illegible} fields set to N/A.', {"report_no": "X"}),
+])
+def test_parse_reply_repairs_common_model_slips(text, expected):
+    assert app.parse_reply(text) == (expected, True)
+
+
+@pytest.mark.parametrize("text", ["{", "```json\n{\n```", '{"comment": "unreadable"'])
+def test_parse_reply_rejects_repairs_without_form_fields(text):
+    with pytest.raises(ValueError):
+        app.parse_reply(text)
+
+
+def test_parse_reply_flags_reply_cut_off_mid_string():
+    data, repaired = app.parse_reply('{"report_no": "X", "hazard_description": "Fuel le')
+
+    assert repaired
+    assert data["report_no"] == "X"
+
+
+def test_prompt_asks_for_every_schema_field():
+    for field, fmt in app.SCHEMA.items():
+        assert f'"{field}": "{fmt}"' in app.EXTRACTION_PROMPT
+    assert list(app.DEFAULT_DATA) == list(app.SCHEMA)
@@ -0,0 +1,151 @@
+import asyncio
+import io
+
+import app
+
+
+class _Upload(io.BytesIO):
+    """Stand-in for Streamlit's UploadedFile: a byte buffer with a name."""
+
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+
+
+class _Reply:
+    def __init__(self, text):
+        self.text = text
+
+
+class _Model:
+    def __init__(self, text):
+        self.text = text
+        self.calls = 0
+
+    async def generate_content_async(self, parts):
+        self.calls += 1
+        return _Reply(self.text)
+
+
+def _process(model, upload, cache=None):
+    return asyncio.run(app.process_image(model, upload, asyncio.Semaphore(1), {} if cache is None else cache))
+
+
+def _png(width=8):
+    from PIL import Image
+
+    buf = io.BytesIO()
+    Image.new("RGB", (width, 8), "white").save(buf, "PNG")
+    return buf.getvalue()
+
+
+def test_unreadable_upload_becomes_error_row():
+    model = _Model('{"report_no": "R1"}')
+    data = _process(model, _Upload(b"not an image", "broken.jpg"))
+
+    assert model.calls == 0
+    assert data["report_no"] == "Error-broken.jpg"
+    assert data["hazard_description"].startswith("AI Error:")
+
+
+def test_reply_with_trailing_prose_is_parsed_and_merged_with_defaults():
+    model = _Model('```json\n{"report_no": "R1"}\n```\nFields marked {illegible} were set to N/A.')
+    data = _process(model, _Upload(_png(), "form.png"))
+
+    assert data["report_no"] == "R1"
+    assert data["cap_required"] == "No"
+    assert data["hazard_description"] == "Extraction Failed"
+
+
+def _sent_size(upload):
+    from PIL import Image
+
+    seen = []
+
+    class _Capture(_Model):
+        async def generate_content_async(self, parts):
+            seen.append(parts[1])
+            return await super().generate_content_async(parts)
+
+    _process(_Capture('{"report_no": "R1"}'), upload)
+    assert seen[0]["mime_type"] == "image/jpeg"
+    return Image.open(io.BytesIO(seen[0]["data"])).size
+
+
+def _encoded(fmt, size):
+    from PIL import Image
+
+    buf = io.BytesIO()
+    Image.new("RGB", size, "white").save(buf, fmt)
+    return buf.getvalue()
+
+
+def test_large_scans_are_sent_as_bounded_jpeg():
+    assert _sent_size(_Upload(_encoded("JPEG", (4000, 3000)), "big.jpg")) == (app.MAX_IMAGE_EDGE, 1200)
+    assert _sent_size(_Upload(_encoded("PNG", (3000, 4000)), "big.png")) == (1200, app.MAX_IMAGE_EDGE)
+
+
+def test_small_scans_are_not_upscaled():
+    assert _sent_size(_Upload(_encoded("PNG", (800, 600)), "small.png")) == (800, 600)
+
+
+def test_repeat_upload_is_served_from_cache():
+    model = _Model('{"report_no": "R1"}')
+    cache = {}
+    first = _process(model, _Upload(_png(), "a.png"), cache)
+    second = _process(model, _Upload(_png(), "copy-of-a.png"), cache)
+
+    assert model.calls == 1
+    assert second == first
+
+
+def test_failed_extractions_are_not_cached():
+    cache = {}
+    _process(_Model("no json here"), _Upload(_png(), "a.png"), cache)
+    _process(_Model('["not", "an", "object"]'), _Upload(_png(), "a.png"), cache)
+    _process(_Model('{}'), _Upload(_png(), "a.png"), cache)
+    _process(_Model('{"report_no": "R0", "hazard_description": "Fuel le'), _Upload(_png(), "a.png"), cache)
+    model = _Model('{"report_no": "R1"}')
+
+    assert _process(model, _Upload(_png(), "a.png"), cache)["report_no"] == "R1"
+    assert model.calls == 1
+
+
+def test_rows_keep_default_column_order_and_do_not_share_state():
+    first = _process(_Model('{"cap_required": "Yes", "report_no": "R1"}'), _Upload(_png(), "a.png"))
+    failed = _process(_Model("no json"), _Upload(b"x", "b.png"))
+
+    assert list(first)[:len(app.DEFAULT_DATA)] == list(app.DEFAULT_DATA)
+    assert list(failed)[:len(app.DEFAULT_DATA)] == list(app.DEFAULT_DATA)
+    assert failed["report_no"] == "Error-b.png"
+    assert app.DEFAULT_DATA["report_no"] == "N/A"
+    assert app.DEFAULT_DATA["hazard_description"] == "Extraction Failed"
+
+
+def test_repaired_replies_are_flagged():
+    data = _process(_Model('{"report_no": "R1", "hazard_description": "Fuel le'), _Upload(_png(), "a.png"))
+
+    assert data["report_no"] == "R1"
+    assert data["extraction_error"] == "RepairedReply"
+
+
+def test_truncated_reply_becomes_error_row():
+    data = _process(_Model("{"), _Upload(_png(), "a.png"))
+
+    assert data["report_no"] == "Error-a.png"
+    assert data["extraction_error"] == "ValueError"
+
+
+class _Failing(_Model):
+    async def generate_content_async(self, parts):
+        raise RuntimeError("429 Resource exhausted\n" + "retry payload " * 50)
+
+
+def test_error_rows_are_short_and_tagged_with_the_error_class():
+    data = _process(_Failing(""), _Upload(_png(), "a.png"))
+
+    assert data["hazard_description"].startswith("AI Error: 429 Resource exhausted")
+    assert "\n" not in data["hazard_description"]
+    assert len(data["hazard_description"]) <= len("AI Error: ") + app.ERROR_MESSAGE_CHARS
+    assert data["extraction_error"] == "RuntimeError"
+    assert "extraction_error" not in _process(_Model('{"report_no": "R1"}'), _Upload(_png(), "b.png"))
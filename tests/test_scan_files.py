@@ -0,0 +1,39 @@
+import asyncio
+import io
+
+import google.generativeai as genai
+
+import app
+from test_process_image import _Model, _Reply, _Upload, _png
+
+
+class _SlowFirst(_Model):
+    """Names each scan after its image width and answers the first upload last."""
+
+    async def generate_content_async(self, parts):
+        from PIL import Image
+
+        width = Image.open(io.BytesIO(parts[1]["data"])).width
+        await asyncio.sleep(0.05 if width == 1 else 0)
+        return _Reply('{"report_no": "R%d"}' % width)
+
+
+def test_results_keep_upload_order_and_progress_counts_completions():
+    model = _SlowFirst("")
+    uploads = [_Upload(_png(width), f"f{width}.png") for width in (1, 2, 3)]
+    progress = []
+
+    results = asyncio.run(app.scan_files(model, "key-a", uploads, progress.append, {}))
+
+    assert [r["report_no"] for r in results] == ["R1", "R2", "R3"]
+    assert progress == [1, 2, 3]
+
+
+def test_async_client_is_bound_to_the_callers_key():
+    model = _Model('{"report_no": "R1"}')
+    # Another session configuring a different key must not leak into ours.
+    genai.configure(api_key="someone-else")
+
+    asyncio.run(app.scan_files(model, "key-a", [_Upload(_png(), "f.png")], lambda done: None, {}))
+
+    assert model._async_client._client._transport._credentials.token == "key-a"